@@ -1,70 +1,255 @@
 # runner.py
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import copy
+import functools
+import glob
+import itertools
 import logging
 import os
-import pathlib
+import shlex
 import signal
 import subprocess
 import sys
-from logging.handlers import RotatingFileHandler
+import threading
+import traceback
+from logging.handlers import MemoryHandler, RotatingFileHandler
+from pathlib import Path
+from zoneinfo import ZoneInfo
 
 import yaml
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
-from pytz import timezone
+
+# The log format uses none of these LogRecord fields; skip collecting them
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+logging.logAsyncioTasks = False
 
 DEFAULT_TZ = "America/New_York"
+# APScheduler's own default. Workers spend their time blocked in proc.wait() and
+# use no CPU, so size for how many jobs may overlap rather than for core count
+DEFAULT_WORKERS = 10
+JOB_DEFAULTS = {
+    "max_instances": 1,  # prevent overlap per job
+    "coalesce": True,  # catch-up collapse
+    "misfire_grace_time": 300,
+}
+# Shared by every handler; second-resolution timestamps skip the msecs suffix
+_LOG_FORMATTER = logging.Formatter(
+    "%(asctime)s %(levelname)s %(message)s", datefmt="%Y-%m-%dT%H:%M:%S"
+)
+# libyaml-backed loader when available; pure-Python SafeLoader otherwise
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+if os.environ.get("RUNNER_WARMUP", "1") == "1":
+    # One throwaway parse so the loader's first-use setup happens at import, not
+    # on the first config load (yaml._yaml itself is already imported by now)
+    try:
+        yaml.load("a: 1", Loader=_YAML_LOADER)
+    except yaml.YAMLError:
+        pass
+# Characters that only mean something to /bin/sh; warn when a non-shell cmd has them
+_SHELL_METACHARS = frozenset("|&;<>$`*?[")
+# Parsed job lists keyed by config path -> (st_mtime_ns, st_size, jobs). Groundwork for
+# config reloads: each entry point loads once today. An edit that keeps the size within
+# the filesystem's mtime granularity is not detected.
+_JOBS_CACHE: dict[str, tuple[int, int, list]] = {}
+# Jobs usually share a handful of zones; build each tzinfo once
+_tz_cache = functools.lru_cache(maxsize=None)(ZoneInfo)
+
+
+@functools.lru_cache(maxsize=512)
+def _cron_trigger(spec: str, tz_name: str) -> CronTrigger:
+    # CronTrigger holds no per-job state, so identical specs can share one instance
+    return CronTrigger.from_crontab(spec, timezone=_tz_cache(tz_name))
+
+
+@functools.lru_cache(maxsize=1)
+def _base_resolved() -> str:
+    # Base directory for all runner configs; adjust as you like
+    base = os.environ.get("RUNNER_CONFIG_BASE", "/etc/python-runner")
+    return os.path.realpath(os.path.expanduser(base))
+
+
 def safe_config_path(raw_path: str) -> Path:
     """
     Resolve a config path and ensure it stays under an allowed base dir.
     Raises ValueError if it escapes.
     """
-    # Base directory for all runner configs; adjust as you like
-    base = Path(os.environ.get("RUNNER_CONFIG_BASE", "/etc/python-runner")).expanduser()
-    base_resolved = base.resolve(strict=False)
-
-    p = Path(raw_path).expanduser()
-    resolved = p.resolve(strict=False)
+    base_resolved = _base_resolved()
+    resolved = os.path.realpath(os.path.expanduser(raw_path))
 
     # Ensure resolved is base or inside base
-    if resolved == base_resolved or base_resolved in resolved.parents:
-        return resolved
+    try:
+        inside = os.path.commonpath([base_resolved, resolved]) == base_resolved
+    except ValueError:  # e.g. different drives on Windows
+        inside = False
+    if not inside:
+        raise ValueError(f"Unsafe config path outside base dir: {resolved}")
+    return Path(resolved)
+
+
+# Single worker keeps rollovers ordered; see BackgroundRotatingFileHandler
+_ROTATION_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="log-rotate"
+)
+
 
-    raise ValueError(f"Unsafe config path outside base dir: {resolved}")
+def _report_rotation_error(future):
+    # Same reporting as Handler.handleError: a traceback on stderr, never into the log
+    exc = future.exception()
+    if exc is not None and logging.raiseExceptions:
+        sys.stderr.write("--- Logging error ---\n")
+        traceback.print_exception(exc, file=sys.stderr)
+        sys.stderr.write("Backup rotation failed; its .rotating file was left in place\n")
+
+
+class BackgroundRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler whose rollover only renames the live file inline.
+    Renumbering older backups and dropping the oldest happen on
+    _ROTATION_EXECUTOR so logging calls never wait on that work.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending_ids = itertools.count(1)
+        if self.backupCount > 0:
+            # A crashed run can leave moved-aside files whose shift never ran; fold
+            # them into the backups, oldest first, so backupCount still caps disk use
+            leftovers = glob.glob(f"{glob.escape(self.baseFilename)}.rotating.*")
+            for pending in sorted(leftovers, key=os.path.getmtime):
+                self._submit_shift(pending)
+
+    def doRollover(self):
+        if self.backupCount <= 0:
+            super().doRollover()
+            return
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename):
+            pending = self._pending_name()
+            os.replace(self.baseFilename, pending)
+            self._submit_shift(pending)
+        if not self.delay:
+            self.stream = self._open()
+
+    def _pending_name(self):
+        # pid keeps names distinct across restarts; never clobber a file a crashed
+        # run left behind before its backup shift ran
+        while True:
+            pending = f"{self.baseFilename}.rotating.{os.getpid()}.{next(self._pending_ids)}"
+            if not os.path.exists(pending):
+                return pending
+
+    def _submit_shift(self, pending):
+        try:
+            future = _ROTATION_EXECUTOR.submit(self._shift_backups, pending)
+        except RuntimeError:
+            # Executor already shut down (process is stopping); finish inline
+            self._shift_backups(pending)
+        else:
+            future.add_done_callback(_report_rotation_error)
+
+    def _shift_backups(self, pending):
+        for i in range(self.backupCount - 1, 0, -1):
+            sfn = self.rotation_filename(f"{self.baseFilename}.{i}")
+            dfn = self.rotation_filename(f"{self.baseFilename}.{i + 1}")
+            if os.path.exists(sfn):
+                os.replace(sfn, dfn)
+        dfn = self.rotation_filename(f"{self.baseFilename}.1")
+        if os.path.exists(dfn):
+            os.remove(dfn)
+        self.rotate(pending, dfn)
 
 
 def setup_logging(logfile):
     logger = logging.getLogger("runner")
     logger.setLevel(logging.INFO)
-    handler = RotatingFileHandler(logfile, maxBytes=10_000_000, backupCount=5)
-    fmt = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
-    handler.setFormatter(fmt)
+    file_handler = BackgroundRotatingFileHandler(logfile, maxBytes=100_000_000, backupCount=5)
+    file_handler.setFormatter(_LOG_FORMATTER)
+    # Batch file writes; errors and flush_logs() push the buffer out immediately
+    handler = MemoryHandler(
+        capacity=1024, flushLevel=logging.ERROR, target=file_handler, flushOnClose=True
+    )
     logger.addHandler(handler)
     console = logging.StreamHandler(sys.stdout)
-    console.setFormatter(fmt)
+    console.setFormatter(_LOG_FORMATTER)
     logger.addHandler(console)
     return logger
 
 
-def run_job(cmd, env, logger):
-    logger.info(f"START: {cmd}")
+def flush_logs(logger):
+    for handler in logger.handlers:
+        handler.flush()
+
+
+def _stream_output(pipe, logger, level, label, cmd):
+    """Log each line from a child pipe, tagged with its command, as soon as it arrives."""
+    with pipe:
+        if not logger.isEnabledFor(level):
+            # Still drain the pipe so the child never blocks on a full buffer
+            for _ in pipe:
+                pass
+            return
+        for line in pipe:
+            # Raw bytes off the pipe; decode once, right before logging
+            logger.log(
+                level, "%s %s: %s", label, cmd, line.rstrip().decode("utf-8", "replace")
+            )
+
+
+def run_job(cmd, argv, env, logger, shell=False):
+    logger.info("START: %s", cmd)
+    proc = err_reader = None
     try:
-        cp = subprocess.run(cmd, shell=True, check=False, capture_output=True, text=True, env=env)
-        logger.info(f"EXIT {cp.returncode}: {cmd}")
-        if cp.stdout:
-            logger.info(f"STDOUT:\n{cp.stdout.strip()}")
-        if cp.stderr:
-            logger.warning(f"STDERR:\n{cp.stderr.strip()}")
+        proc = subprocess.Popen(
+            argv,
+            shell=shell,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+        # Drain stderr on a helper thread so neither pipe can fill up and stall the child
+        err_reader = threading.Thread(
+            target=_stream_output,
+            args=(proc.stderr, logger, logging.WARNING, "STDERR", cmd),
+            daemon=True,
+        )
+        err_reader.start()
+        _stream_output(proc.stdout, logger, logging.INFO, "STDOUT", cmd)
+        err_reader.join()
+        returncode = proc.wait()
+        logger.info("EXIT %s: %s", returncode, cmd)
     except Exception as e:
-        logger.exception(f"Job failed: {cmd} :: {e}")
+        logger.exception("Job failed: %s :: %s", cmd, e)
+    finally:
+        # Don't leave an orphaned child or reader behind if streaming failed midway
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if err_reader is not None and err_reader.is_alive():
+            # Bounded: a grandchild of a shell job can keep stderr open after the kill
+            err_reader.join(timeout=5)
+        flush_logs(logger)
 
 
 def load_jobs(path):
     cfg_path = safe_config_path(str(path))
+    st = cfg_path.stat()
+    cached = _JOBS_CACHE.get(str(cfg_path))
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        # Callers get their own copy; the cached list must stay as parsed
+        return copy.deepcopy(cached[2])
     with cfg_path.open("r", encoding="utf-8") as f:
-        data = yaml.safe_load(f) or {}
-    return data.get("jobs", [])
+        data = yaml.load(f, Loader=_YAML_LOADER) or {}
+    jobs = data.get("jobs", [])
+    _JOBS_CACHE[str(cfg_path)] = (st.st_mtime_ns, st.st_size, jobs)
+    return copy.deepcopy(jobs)
 
 # def load_jobs(path):
 #     with open(path, "r", encoding="utf-8") as f:
@@ -72,6 +257,16 @@ def load_jobs(path):
 #     return data.get("jobs", [])
 
 
+def _positive_int(value):
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value!r}")
+    return n
+
+
 def main():
     ap = argparse.ArgumentParser(
         description="Single-process task scheduler (cron-like) for Python/tools."
@@ -79,13 +274,19 @@ def main():
     ap.add_argument("-c", "--config", required=True, help="YAML file with jobs")
     ap.add_argument("--log", default="/var/log/python-runner.log", help="Log file path")
     ap.add_argument("--tz", default=DEFAULT_TZ, help="Default timezone for jobs")
+    ap.add_argument(
+        "--workers",
+        type=_positive_int,
+        default=DEFAULT_WORKERS,
+        help="Max jobs running concurrently",
+    )
     ap.add_argument(
         "--env", action="append", default=[], help="Extra env like KEY=VALUE (can repeat)"
     )
     args = ap.parse_args()
 
     # Logging
-    pathlib.Path(os.path.dirname(args.log) or ".").mkdir(parents=True, exist_ok=True)
+    Path(args.log).parent.mkdir(parents=True, exist_ok=True)
     logger = setup_logging(args.log)
     logger.info("Python Runner starting")
 
@@ -96,43 +297,63 @@ def main():
         base_env[k] = v
 
     # Scheduler
-    sched = BlockingScheduler(timezone=timezone(args.tz))
+    sched = BlockingScheduler(
+        timezone=_tz_cache(args.tz),
+        executors={"default": ThreadPoolExecutor(max_workers=args.workers)},
+        job_defaults=JOB_DEFAULTS,
+    )
 
     # Load jobs
     for job in load_jobs(args.config):
         name = job["name"]
         cmd = job["cmd"]
         spec = job["when"]  # standard 5-field crontab string (min hour day month dow)
+        # Exec directly (posix_spawn-eligible) unless the job opts into `shell: true`
+        shell = bool(job.get("shell", False))
+        if shell:
+            argv = cmd
+        else:
+            try:
+                argv = shlex.split(cmd)
+            except ValueError as e:
+                logger.error("JOB SKIPPED: %s: cannot parse cmd %r: %s", name, cmd, e)
+                continue
+            if _SHELL_METACHARS.intersection(cmd) or any(a.startswith("~") for a in argv):
+                logger.warning(
+                    "JOB %s runs without a shell but cmd has shell syntax; "
+                    "set `shell: true` if it needs one: %s",
+                    name,
+                    cmd,
+                )
         jtz = job.get("timezone") or args.tz
-        env = base_env.copy()
-        for kv in job.get("env", []):
-            k, _, v = kv.partition("=")
-            env[k] = v
+        overrides = {k: v for k, _, v in (kv.partition("=") for kv in job.get("env", []))}
+        env = {**base_env, **overrides}
 
-        trigger = CronTrigger.from_crontab(spec, timezone=timezone(jtz))
+        trigger = _cron_trigger(spec, jtz)
         sched.add_job(
             run_job,
             trigger=trigger,
-            args=[cmd, env, logger],
+            args=[cmd, argv, env, logger, shell],
             id=name,
             name=name,
             replace_existing=True,
-            max_instances=1,  # prevent overlap per job
-            coalesce=True,  # catch-up collapse
-            misfire_grace_time=300,
         )
-        logger.info(f"JOB LOADED: {name} @ {spec} [{jtz}] -> {cmd}")
+        logger.info("JOB LOADED: %s @ %s [%s] -> %s", name, spec, jtz, cmd)
 
     # Graceful shutdown
     def _stop(signum, frame):
-        logger.info(f"Received signal {signum}, shutting down…")
+        logger.info("Received signal %s, shutting down…", signum)
         sched.shutdown(wait=False)
+        flush_logs(logger)
+        _ROTATION_EXECUTOR.shutdown(wait=True)
         sys.exit(0)
 
     for s in (signal.SIGINT, signal.SIGTERM):
         signal.signal(s, _stop)
 
     logger.info("Scheduler started")
+    # Startup and JOB LOADED lines shouldn't wait in the buffer for the first job to finish
+    flush_logs(logger)
     sched.start()
 
 
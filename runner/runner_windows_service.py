@@ -1,11 +1,20 @@
 # runner_windows_service.py
 #!/usr/bin/env python3
+import concurrent.futures
+import copy
+import functools
+import glob
+import itertools
+import locale
 import logging
 import os
-import pathlib
 import subprocess
 import sys
-from logging.handlers import RotatingFileHandler
+import threading
+import traceback
+from logging.handlers import MemoryHandler, RotatingFileHandler
+from pathlib import Path
+from zoneinfo import ZoneInfo
 
 import servicemanager
 
@@ -14,51 +23,260 @@ import win32event
 import win32service
 import win32serviceutil
 import yaml
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from pytz import timezone
+
+# The log format uses none of these LogRecord fields; skip collecting them
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+logging.logAsyncioTasks = False
 
 DEFAULT_TZ = "America/New_York"
+# APScheduler's own default. Workers spend their time blocked in proc.wait() and
+# use no CPU, so size for how many jobs may overlap rather than for core count
+DEFAULT_WORKERS = 10
+JOB_DEFAULTS = {
+    "max_instances": 1,  # prevent overlap per job
+    "coalesce": True,  # catch-up collapse
+    "misfire_grace_time": 300,
+}
+# Shared by every handler; second-resolution timestamps skip the msecs suffix
+_LOG_FORMATTER = logging.Formatter(
+    "%(asctime)s %(levelname)s %(message)s", datefmt="%Y-%m-%dT%H:%M:%S"
+)
+# libyaml-backed loader when available; pure-Python SafeLoader otherwise
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+if os.environ.get("RUNNER_WARMUP", "1") == "1":
+    # One throwaway parse so the loader's first-use setup happens at import, not
+    # on the first config load (yaml._yaml itself is already imported by now)
+    try:
+        yaml.load("a: 1", Loader=_YAML_LOADER)
+    except yaml.YAMLError:
+        pass
+# Console tools write in the ANSI code page, not UTF-8; same codec text=True would use
+_OUTPUT_ENCODING = locale.getencoding()
+# Characters that only mean something to cmd.exe; warn when a non-shell cmd has them
+_SHELL_METACHARS = frozenset("|&<>^%")
+# cmd.exe builtins have no executable of their own and fail without `shell: true`
+_CMD_BUILTINS = frozenset(
+    "assoc call cd copy del dir echo erase md mkdir move rd ren rename rmdir set start type"
+    " ver vol".split()
+)
+# Parsed job lists keyed by config path -> (st_mtime_ns, st_size, jobs). Groundwork for
+# config reloads: each entry point loads once today. An edit that keeps the size within
+# the filesystem's mtime granularity is not detected.
+_JOBS_CACHE: dict[str, tuple[int, int, list]] = {}
+# Jobs usually share a handful of zones; build each tzinfo once
+_tz_cache = functools.lru_cache(maxsize=None)(ZoneInfo)
+
+
+@functools.lru_cache(maxsize=512)
+def _cron_trigger(spec: str, tz_name: str) -> CronTrigger:
+    # CronTrigger holds no per-job state, so identical specs can share one instance
+    return CronTrigger.from_crontab(spec, timezone=_tz_cache(tz_name))
+
+
+@functools.lru_cache(maxsize=1)
+def _base_resolved() -> str:
+    # Base directory for all runner configs; adjust as you like
+    base = os.environ.get("RUNNER_CONFIG_BASE", r"C:\etc\python-runner")
+    return os.path.realpath(os.path.expanduser(base))
+
 
 def safe_config_path(raw_path: str) -> Path:
     """
     Resolve a config path and ensure it stays under an allowed base dir.
     Raises ValueError if it escapes.
     """
-    # Base directory for all runner configs; adjust as you like
-    base = Path(os.environ.get("RUNNER_CONFIG_BASE", r"C:\etc\python-runner")).expanduser()
-    base_resolved = base.resolve(strict=False)
-
-    p = Path(raw_path).expanduser()
-    resolved = p.resolve(strict=False)
+    base_resolved = _base_resolved()
+    resolved = os.path.realpath(os.path.expanduser(raw_path))
 
     # Ensure resolved is base or inside base
-    if resolved == base_resolved or base_resolved in resolved.parents:
-        return resolved
+    try:
+        inside = os.path.commonpath([base_resolved, resolved]) == base_resolved
+    except ValueError:  # e.g. different drives on Windows
+        inside = False
+    if not inside:
+        raise ValueError(f"Unsafe config path outside base dir: {resolved}")
+    return Path(resolved)
+
+
+# Single worker keeps rollovers ordered; see BackgroundRotatingFileHandler
+_ROTATION_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="log-rotate"
+)
+
+
+def _report_rotation_error(future):
+    # Same reporting as Handler.handleError: a traceback on stderr, never into the log
+    exc = future.exception()
+    if exc is not None and logging.raiseExceptions:
+        sys.stderr.write("--- Logging error ---\n")
+        traceback.print_exception(exc, file=sys.stderr)
+        sys.stderr.write("Backup rotation failed; its .rotating file was left in place\n")
+
+
+class BackgroundRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler whose rollover only renames the live file inline.
+    Renumbering older backups and dropping the oldest happen on
+    _ROTATION_EXECUTOR so logging calls never wait on that work.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending_ids = itertools.count(1)
+        if self.backupCount > 0:
+            # A crashed run can leave moved-aside files whose shift never ran; fold
+            # them into the backups, oldest first, so backupCount still caps disk use
+            leftovers = glob.glob(f"{glob.escape(self.baseFilename)}.rotating.*")
+            for pending in sorted(leftovers, key=os.path.getmtime):
+                self._submit_shift(pending)
+
+    def doRollover(self):
+        if self.backupCount <= 0:
+            super().doRollover()
+            return
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename):
+            pending = self._pending_name()
+            os.replace(self.baseFilename, pending)
+            self._submit_shift(pending)
+        if not self.delay:
+            self.stream = self._open()
+
+    def _pending_name(self):
+        # pid keeps names distinct across restarts; never clobber a file a crashed
+        # run left behind before its backup shift ran
+        while True:
+            pending = f"{self.baseFilename}.rotating.{os.getpid()}.{next(self._pending_ids)}"
+            if not os.path.exists(pending):
+                return pending
+
+    def _submit_shift(self, pending):
+        try:
+            future = _ROTATION_EXECUTOR.submit(self._shift_backups, pending)
+        except RuntimeError:
+            # Executor already shut down (process is stopping); finish inline
+            self._shift_backups(pending)
+        else:
+            future.add_done_callback(_report_rotation_error)
+
+    def _shift_backups(self, pending):
+        for i in range(self.backupCount - 1, 0, -1):
+            sfn = self.rotation_filename(f"{self.baseFilename}.{i}")
+            dfn = self.rotation_filename(f"{self.baseFilename}.{i + 1}")
+            if os.path.exists(sfn):
+                os.replace(sfn, dfn)
+        dfn = self.rotation_filename(f"{self.baseFilename}.1")
+        if os.path.exists(dfn):
+            os.remove(dfn)
+        self.rotate(pending, dfn)
+
+
+class BufferedRotatingFileHandler(BackgroundRotatingFileHandler):
+    """
+    BackgroundRotatingFileHandler that writes through a 64 KiB buffer and
+    flushes on a timer instead of after every record. Only safe because
+    the service is the sole writer of its log file.
+
+    The stream is binary: each record is encoded once in emit(), and the
+    encoded length is what counts towards maxBytes.
+    """
+
+    flush_interval = 1.0
+
+    def __init__(self, *args, **kwargs):
+        self._flush_timer = None
+        self._size = 0
+        super().__init__(*args, **kwargs)
+        self._codec = locale.getencoding() if self.encoding == "locale" else self.encoding
+
+    def _open(self):
+        mode = self.mode if "b" in self.mode else f"{self.mode}b"
+        stream = self._builtin_open(self.baseFilename, mode, buffering=1 << 16)
+        self._size = os.fstat(stream.fileno()).st_size
+        return stream
+
+    def emit(self, record):
+        # Same as RotatingFileHandler.emit, but rollover is decided from a running
+        # size count: seek()/tell() on the buffered stream would force a flush
+        try:
+            msg = self.format(record) + self.terminator
+            data = msg.encode(self._codec, self.errors or "strict")
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self._size + len(data) >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(data)
+            self._size += len(data)
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def _timed_flush(self):
+        with self.lock:
+            self._flush_timer = None
+            self.flush()
+
+    def close(self):
+        with self.lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        super().close()
 
-    raise ValueError(f"Unsafe config path outside base dir: {resolved}")
 
 def setup_logging(logfile):
-    pathlib.Path(os.path.dirname(logfile) or ".").mkdir(parents=True, exist_ok=True)
+    Path(logfile).parent.mkdir(parents=True, exist_ok=True)
     logger = logging.getLogger("runner")
     logger.setLevel(logging.INFO)
-    handler = RotatingFileHandler(logfile, maxBytes=10_000_000, backupCount=5)
-    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    file_handler = BufferedRotatingFileHandler(
+        logfile, maxBytes=100_000_000, backupCount=5, encoding="utf-8"
+    )
+    file_handler.setFormatter(_LOG_FORMATTER)
+    # Batch file writes; errors and flush_logs() push the buffer out immediately
+    handler = MemoryHandler(
+        capacity=1024, flushLevel=logging.ERROR, target=file_handler, flushOnClose=True
+    )
     logger.addHandler(handler)
     console = logging.StreamHandler(sys.stdout)
-    console.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    console.setFormatter(_LOG_FORMATTER)
     logger.addHandler(console)
     return logger
 
 
+def flush_logs(logger):
+    for handler in logger.handlers:
+        handler.flush()
+
+
 def filename_norm(p):
     return os.path.normpath(os.path.expandvars(os.path.expanduser(p)))
 
 def load_jobs(path):
     cfg_path = safe_config_path(str(path))
+    st = cfg_path.stat()
+    cached = _JOBS_CACHE.get(str(cfg_path))
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        # Callers get their own copy; the cached list must stay as parsed
+        return copy.deepcopy(cached[2])
     with cfg_path.open("r", encoding="utf-8") as f:
-        data = yaml.safe_load(f) or {}
-    return data.get("jobs", [])
+        data = yaml.load(f, Loader=_YAML_LOADER) or {}
+    jobs = data.get("jobs", [])
+    _JOBS_CACHE[str(cfg_path)] = (st.st_mtime_ns, st.st_size, jobs)
+    return copy.deepcopy(jobs)
 
 # def load_jobs(path):
 #     with open(path, "r", encoding="utf-8") as f:
@@ -66,17 +284,54 @@ def load_jobs(path):
 #     return data.get("jobs", [])
 
 
-def run_job(cmd, env, logger):
-    logger.info(f"START: {cmd}")
+def _stream_output(pipe, logger, level, label, cmd):
+    """Log each line from a child pipe, tagged with its command, as soon as it arrives."""
+    with pipe:
+        if not logger.isEnabledFor(level):
+            # Still drain the pipe so the child never blocks on a full buffer
+            for _ in pipe:
+                pass
+            return
+        for line in pipe:
+            # Raw bytes off the pipe; decode once, right before logging
+            logger.log(
+                level, "%s %s: %s", label, cmd, line.rstrip().decode(_OUTPUT_ENCODING, "replace")
+            )
+
+
+def run_job(cmd, argv, env, logger, shell=False):
+    logger.info("START: %s", cmd)
+    proc = err_reader = None
     try:
-        cp = subprocess.run(cmd, shell=True, check=False, capture_output=True, text=True, env=env)
-        logger.info(f"EXIT {cp.returncode}: {cmd}")
-        if cp.stdout:
-            logger.info(f"STDOUT:\n{cp.stdout.strip()}")
-        if cp.stderr:
-            logger.warning(f"STDERR:\n{cp.stderr.strip()}")
+        proc = subprocess.Popen(
+            argv,
+            shell=shell,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+        # Drain stderr on a helper thread so neither pipe can fill up and stall the child
+        err_reader = threading.Thread(
+            target=_stream_output,
+            args=(proc.stderr, logger, logging.WARNING, "STDERR", cmd),
+            daemon=True,
+        )
+        err_reader.start()
+        _stream_output(proc.stdout, logger, logging.INFO, "STDOUT", cmd)
+        err_reader.join()
+        returncode = proc.wait()
+        logger.info("EXIT %s: %s", returncode, cmd)
     except Exception as e:
-        logger.exception(f"Job failed: {cmd} :: {e}")
+        logger.exception("Job failed: %s :: %s", cmd, e)
+    finally:
+        # Don't leave an orphaned child or reader behind if streaming failed midway
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if err_reader is not None and err_reader.is_alive():
+            # Bounded: a grandchild of a shell job can keep stderr open after the kill
+            err_reader.join(timeout=5)
+        flush_logs(logger)
 
 
 class PythonRunnerService(win32serviceutil.ServiceFramework):
@@ -95,13 +350,28 @@ class PythonRunnerService(win32serviceutil.ServiceFramework):
         self.default_tz = os.environ.get("RUNNER_TZ", DEFAULT_TZ)
         self.base_env = os.environ.copy()
         self.logger = setup_logging(self.log_path)
-        self.scheduler = BackgroundScheduler(timezone=timezone(self.default_tz))
+        raw_workers = os.environ.get("RUNNER_WORKERS", str(DEFAULT_WORKERS))
+        try:
+            self.workers = int(raw_workers)
+        except ValueError:
+            self.workers = 0
+        if self.workers < 1:
+            self.logger.warning(
+                "Ignoring invalid RUNNER_WORKERS=%r; using %s", raw_workers, DEFAULT_WORKERS
+            )
+            self.workers = DEFAULT_WORKERS
+        self.scheduler = BackgroundScheduler(
+            timezone=_tz_cache(self.default_tz),
+            executors={"default": ThreadPoolExecutor(max_workers=self.workers)},
+            job_defaults=JOB_DEFAULTS,
+        )
 
     def SvcStop(self):
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
         try:
             self.logger.info("Service stop requested.")
             self.scheduler.shutdown(wait=False)
+            flush_logs(self.logger)
         except Exception:
             pass
         win32event.SetEvent(self.stop_event)
@@ -119,34 +389,44 @@ class PythonRunnerService(win32serviceutil.ServiceFramework):
                 name = job["name"]
                 cmd = job["cmd"]
                 spec = job["when"]
+                # CreateProcess takes the command line as-is; `shell: true` routes it via cmd.exe
+                shell = bool(job.get("shell", False))
+                program = cmd.split(maxsplit=1)[0].lower() if cmd.strip() else ""
+                if not shell and (program in _CMD_BUILTINS or _SHELL_METACHARS.intersection(cmd)):
+                    self.logger.warning(
+                        "JOB %s runs without a shell but cmd has shell syntax; "
+                        "set `shell: true` if it needs one: %s",
+                        name,
+                        cmd,
+                    )
                 jtz = job.get("timezone") or self.default_tz
-                env = self.base_env.copy()
-                for kv in job.get("env", []):
-                    k, _, v = kv.partition("=")
-                    env[k] = v
-                trigger = CronTrigger.from_crontab(spec, timezone=timezone(jtz))
+                overrides = {k: v for k, _, v in (kv.partition("=") for kv in job.get("env", []))}
+                env = {**self.base_env, **overrides}
+                trigger = _cron_trigger(spec, jtz)
                 self.scheduler.add_job(
                     run_job,
                     trigger=trigger,
-                    args=[cmd, env, self.logger],
+                    args=[cmd, cmd, env, self.logger, shell],
                     id=name,
                     name=name,
                     replace_existing=True,
-                    max_instances=1,
-                    coalesce=True,
-                    misfire_grace_time=300,
                 )
-                self.logger.info(f"JOB LOADED: {name} @ {spec} [{jtz}] -> {cmd}")
+                self.logger.info("JOB LOADED: %s @ %s [%s] -> %s", name, spec, jtz, cmd)
             self.logger.info("Scheduler starting")
+            # Startup and JOB LOADED lines shouldn't wait in the buffer for the first job
+            flush_logs(self.logger)
             self.scheduler.start()
         except Exception as e:
-            self.logger.exception(f"Failed to start scheduler: {e}")
+            self.logger.exception("Failed to start scheduler: %s", e)
             # Fail fast so the SCM logs it
             raise
 
         # Wait until stop
         win32event.WaitForSingleObject(self.stop_event, win32event.INFINITE)
         self.logger.info("Python Runner service stopped")
+        # Close handlers so the MemoryHandler and file write buffers reach disk
+        logging.shutdown()
+        _ROTATION_EXECUTOR.shutdown(wait=True)
 
 
 if __name__ == "__main__":
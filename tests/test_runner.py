@@ -0,0 +1,147 @@
+import logging
+import os
+
+import pytest
+
+from runner import runner
+
+
+def _drain_rotation():
+    # Single worker: once this no-op runs, every queued shift (and its callback) has too
+    runner._ROTATION_EXECUTOR.submit(lambda: None).result()
+
+
+@pytest.fixture
+def config_base(tmp_path, monkeypatch):
+    base = tmp_path / "configs"
+    base.mkdir()
+    monkeypatch.setenv("RUNNER_CONFIG_BASE", str(base))
+    runner._base_resolved.cache_clear()
+    runner._JOBS_CACHE.clear()
+    yield base
+    runner._base_resolved.cache_clear()
+    runner._JOBS_CACHE.clear()
+
+
+def _record(msg):
+    return logging.LogRecord("runner", logging.INFO, __file__, 0, msg, None, None)
+
+
+# --- safe_config_path ---
+
+
+def test_safe_config_path_accepts_paths_under_base(config_base):
+    assert runner.safe_config_path(str(config_base)) == config_base.resolve()
+    jobs = config_base / "jobs.yaml"
+    assert runner.safe_config_path(str(jobs)) == jobs.resolve()
+    nested = config_base / "sub" / ".." / "jobs.yaml"
+    assert runner.safe_config_path(str(nested)) == jobs.resolve()
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        "{base}x/jobs.yaml",  # sibling sharing the base as a string prefix
+        "{base}/../outside.yaml",
+        "/etc/passwd",
+    ],
+)
+def test_safe_config_path_rejects_paths_outside_base(config_base, raw):
+    with pytest.raises(ValueError, match="Unsafe config path"):
+        runner.safe_config_path(raw.format(base=config_base))
+
+
+def test_safe_config_path_rejects_symlink_escaping_base(config_base, tmp_path):
+    outside = tmp_path / "outside.yaml"
+    outside.write_text("jobs: []\n")
+    (config_base / "link.yaml").symlink_to(outside)
+    with pytest.raises(ValueError, match="Unsafe config path"):
+        runner.safe_config_path(str(config_base / "link.yaml"))
+
+
+# --- load_jobs ---
+
+
+def test_load_jobs_reparses_when_file_changes(config_base):
+    cfg = config_base / "jobs.yaml"
+    cfg.write_text("jobs:\n  - name: a\n")
+    assert [j["name"] for j in runner.load_jobs(cfg)] == ["a"]
+
+    cfg.write_text("jobs:\n  - name: b\n  - name: c\n")
+    assert [j["name"] for j in runner.load_jobs(cfg)] == ["b", "c"]
+
+
+def test_load_jobs_detects_same_size_edit_with_new_mtime(config_base):
+    cfg = config_base / "jobs.yaml"
+    cfg.write_text("jobs:\n  - name: a\n")
+    os.utime(cfg, ns=(1_000_000_000, 1_000_000_000))
+    runner.load_jobs(cfg)
+
+    cfg.write_text("jobs:\n  - name: b\n")
+    os.utime(cfg, ns=(2_000_000_000, 2_000_000_000))
+    assert [j["name"] for j in runner.load_jobs(cfg)] == ["b"]
+
+
+def test_load_jobs_returns_independent_copies(config_base):
+    cfg = config_base / "jobs.yaml"
+    cfg.write_text("jobs:\n  - name: a\n    env: [X=1]\n")
+    first = runner.load_jobs(cfg)
+    first[0]["env"].append("Y=2")
+    first.append({"name": "extra"})
+
+    assert runner.load_jobs(cfg) == [{"name": "a", "env": ["X=1"]}]
+
+
+# --- BackgroundRotatingFileHandler ---
+
+
+def test_rollover_shifts_backups_and_drops_oldest(tmp_path):
+    log = tmp_path / "run.log"
+    handler = runner.BackgroundRotatingFileHandler(log, maxBytes=20, backupCount=2)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    try:
+        for msg in ("first-record", "second-record", "third-record", "fourth-record"):
+            handler.emit(_record(msg))
+            _drain_rotation()
+    finally:
+        handler.close()
+
+    assert log.read_text() == "fourth-record\n"
+    assert (tmp_path / "run.log.1").read_text() == "third-record\n"
+    assert (tmp_path / "run.log.2").read_text() == "second-record\n"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["run.log", "run.log.1", "run.log.2"]
+
+
+def test_leftover_pending_file_is_folded_into_backups(tmp_path):
+    log = tmp_path / "run.log"
+    (tmp_path / "run.log.1").write_text("older\n")
+    (tmp_path / "run.log.rotating.12345.1").write_text("crashed run\n")
+
+    handler = runner.BackgroundRotatingFileHandler(log, maxBytes=100, backupCount=3)
+    _drain_rotation()
+    handler.close()
+
+    assert (tmp_path / "run.log.1").read_text() == "crashed run\n"
+    assert (tmp_path / "run.log.2").read_text() == "older\n"
+    assert not list(tmp_path.glob("run.log.rotating.*"))
+
+
+def test_failed_backup_shift_is_reported(tmp_path, capsys, monkeypatch):
+    log = tmp_path / "run.log"
+    handler = runner.BackgroundRotatingFileHandler(log, maxBytes=100, backupCount=2)
+
+    def _fail(pending):
+        raise PermissionError(13, "file in use", pending)
+
+    monkeypatch.setattr(handler, "_shift_backups", _fail)
+    try:
+        handler.emit(_record("x"))
+        handler.doRollover()
+        _drain_rotation()
+    finally:
+        handler.close()
+
+    err = capsys.readouterr().err
+    assert "--- Logging error ---" in err
+    assert "PermissionError" in err
+    assert len(list(tmp_path.glob("run.log.rotating.*"))) == 1
@@ -0,0 +1,86 @@
+import importlib
+import logging
+import sys
+import time
+import types
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def service():
+    # pywin32 only exists on Windows; the handler code under test doesn't touch it
+    with pytest.MonkeyPatch.context() as mp:
+        for name in ("servicemanager", "win32event", "win32service", "win32serviceutil"):
+            mp.setitem(sys.modules, name, types.ModuleType(name))
+        sys.modules["win32serviceutil"].ServiceFramework = object
+        yield importlib.import_module("runner.runner_windows_service")
+
+
+def _drain_rotation(service):
+    service._ROTATION_EXECUTOR.submit(lambda: None).result()
+
+
+def _handler(service, path, **kwargs):
+    handler = service.BufferedRotatingFileHandler(path, encoding="utf-8", **kwargs)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    return handler
+
+
+def _record(msg):
+    return logging.LogRecord("runner", logging.INFO, __file__, 0, msg, None, None)
+
+
+def test_writes_are_buffered_until_close(service, tmp_path):
+    log = tmp_path / "svc.log"
+    handler = _handler(service, log, maxBytes=0, backupCount=0)
+    handler.flush_interval = 60
+    handler.emit(_record("hello"))
+    assert log.read_bytes() == b""
+
+    handler.close()
+    assert log.read_bytes() == b"hello\n"
+
+
+def test_timer_flushes_buffered_writes(service, tmp_path):
+    log = tmp_path / "svc.log"
+    handler = _handler(service, log, maxBytes=0, backupCount=0)
+    handler.flush_interval = 0.01
+    try:
+        handler.emit(_record("hello"))
+        deadline = time.monotonic() + 5
+        while log.read_bytes() != b"hello\n" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert log.read_bytes() == b"hello\n"
+    finally:
+        handler.close()
+
+
+def test_rollover_size_counts_encoded_bytes(service, tmp_path):
+    log = tmp_path / "svc.log"
+    handler = _handler(service, log, maxBytes=400, backupCount=3)
+    msg = "é" * 150  # 150 characters, 300 bytes in UTF-8
+    try:
+        for _ in range(3):
+            handler.emit(_record(msg))
+            _drain_rotation(service)
+    finally:
+        handler.close()
+
+    expected = (msg + "\n").encode("utf-8")
+    for name in ("svc.log", "svc.log.1", "svc.log.2"):
+        assert (tmp_path / name).read_bytes() == expected
+
+
+def test_rollover_resumes_size_from_existing_file(service, tmp_path):
+    log = tmp_path / "svc.log"
+    log.write_bytes(b"x" * 15 + b"\n")
+    handler = _handler(service, log, maxBytes=20, backupCount=1)
+    try:
+        handler.emit(_record("next"))
+        _drain_rotation(service)
+    finally:
+        handler.close()
+
+    assert log.read_bytes() == b"next\n"
+    assert (tmp_path / "svc.log.1").read_bytes() == b"x" * 15 + b"\n"